@@ -3,6 +3,8 @@
 -- Uses Python for constrained optimization, Lua for REAPER integration.
 --
 -- Requires: automix_solve.py in the same directory, python3 with numpy/scipy
+-- To print the signal matrix/target analysis, set AUTOMIX_VERBOSE=1 in the
+-- environment REAPER is launched from (the solver omits it otherwise).
 
 local DEFAULT_SPEC_FILENAME = "automix_spec.txt"
 local TRACK_VOL_PARAM = "D_VOL"
@@ -299,7 +301,7 @@ local function main()
     end
 
     -- Display analysis
-    if result.analysis then
+    if result.analysis and result.analysis ~= "" then
         msg("\n" .. result.analysis)
     end
 
@@ -4,29 +4,58 @@ Automix solver - computes optimal fader levels.
 Run from command line, outputs JSON that automix.lua reads.
 
 Usage: python3 automix_solve.py <spec_file> <track_list_file> <output_file>
+       python3 automix_solve.py --batch < jobs.txt
 
 track_list_file contains one track name per line (from REAPER).
 output_file will contain JSON with fader levels.
+In --batch mode each stdin line is one job, solved in the same process:
+spec_file, track_list_file and output_file separated by tabs.
+Set AUTOMIX_VERBOSE=1 to include the signal matrix/target analysis text.
 """
 
 import sys
 import json
+import math
+import os
 import re
 import numpy as np
-from scipy.optimize import minimize
+from scipy.linalg import lstsq
+from scipy.optimize import lsq_linear, nnls
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+USAGE = (
+    "Usage: python3 automix_solve.py <spec_file> <track_list_file> <output_file>\n"
+    "       python3 automix_solve.py --batch < jobs.txt"
+)
+
+RE_NAME_WEIGHT = re.compile(r"(\w+):\s*([0-9.]+)\s*$")
+RE_COMPONENT_WEIGHT = re.compile(r"(direct|early):\s*([0-9.]+)\s*$")
+RE_HALL_GAIN = re.compile(r"hall\s+gain:\s*(-?[0-9.]+)\s*$")
+RE_SIGNAL_NESTED = re.compile(r"signal\s+(\S+):\s*$")
+RE_SIGNAL_INLINE = re.compile(r"signal\s+(\S+):\s*(.+)$")
+RE_SIGNAL_PART = re.compile(r"([0-9.]+)\s+(\S+)")
+
+
+def is_top_level_statement(stripped):
+    """True for target/hall gain/signal lines, which end a nested block at its header's indent."""
+    return (
+        stripped == "target:"
+        or RE_HALL_GAIN.match(stripped) is not None
+        or RE_SIGNAL_NESTED.match(stripped) is not None
+        or RE_SIGNAL_INLINE.match(stripped) is not None
+    )
 
 
 def db_to_linear(db):
-    return 10 ** (db / 20)
-
-
-def linear_to_db(lin):
-    if lin <= 0:
-        return -150
-    return 20 * np.log10(lin)
+    return math.pow(10.0, db / 20.0)
 
 
-def parse_nested_target(lines, start_idx):
+def parse_nested_target(prepared_lines, start_idx, header_indent):
+    """Parse the target block; prepared_lines holds (indent, stripped) tuples."""
     instruments = []
     target_weights = {}
     i = start_idx
@@ -34,15 +63,15 @@ def parse_nested_target(lines, start_idx):
     current_instrument_weight = 0
     base_indent = None
 
-    while i < len(lines):
-        line = lines[i]
-        stripped = line.strip()
+    while i < len(prepared_lines):
+        indent, stripped = prepared_lines[i]
 
         if not stripped or stripped.startswith("#"):
             i += 1
             continue
 
-        indent = len(line) - len(line.lstrip())
+        if indent <= header_indent and is_top_level_statement(stripped):
+            break
 
         if base_indent is None:
             base_indent = indent
@@ -50,7 +79,7 @@ def parse_nested_target(lines, start_idx):
         if indent < base_indent and stripped:
             break
 
-        match = re.match(r"(\w+):\s*([0-9.]+)\s*$", stripped)
+        match = RE_NAME_WEIGHT.match(stripped)
         if match and indent == base_indent:
             current_instrument = match.group(1)
             current_instrument_weight = float(match.group(2))
@@ -59,7 +88,7 @@ def parse_nested_target(lines, start_idx):
             i += 1
             continue
 
-        match = re.match(r"(direct|early):\s*([0-9.]+)\s*$", stripped)
+        match = RE_COMPONENT_WEIGHT.match(stripped)
         if match and current_instrument and indent > base_indent:
             type_name = match.group(1)
             type_weight = float(match.group(2))
@@ -72,38 +101,41 @@ def parse_nested_target(lines, start_idx):
     return instruments, target_weights, i
 
 
-def parse_signal_components(component_str, signal_name, component_index):
+def parse_signal_components(component_str, signal_name):
     result = {}
     for part in component_str.split(","):
         part = part.strip()
-        match = re.match(r"([0-9.]+)\s+(\S+)", part)
+        match = RE_SIGNAL_PART.match(part)
         if match:
             weight = float(match.group(1))
             name = match.group(2)
             if name == "direct":
                 name = f"{signal_name}_direct"
-            if name in component_index:
-                result[component_index[name]] = weight
+            result[name] = weight
     return result
 
 
-def parse_nested_signal(lines, start_idx, component_index):
-    """Parse nested signal format like target format."""
+def parse_nested_signal(prepared_lines, start_idx, header_indent):
+    """Parse nested signal format like target format.
+
+    prepared_lines holds (indent, stripped) tuples, as built by parse_spec_file;
+    header_indent is the indent of the "signal name:" line opening the block.
+    """
     weights = {}
     i = start_idx
     current_instrument = None
     current_instrument_weight = 0
     base_indent = None
 
-    while i < len(lines):
-        line = lines[i]
-        stripped = line.strip()
+    while i < len(prepared_lines):
+        indent, stripped = prepared_lines[i]
 
         if not stripped or stripped.startswith("#"):
             i += 1
             continue
 
-        indent = len(line) - len(line.lstrip())
+        if indent <= header_indent and is_top_level_statement(stripped):
+            break
 
         if base_indent is None:
             base_indent = indent
@@ -112,7 +144,7 @@ def parse_nested_signal(lines, start_idx, component_index):
             break
 
         # Instrument line: "voc: 0.65"
-        match = re.match(r"(\w+):\s*([0-9.]+)\s*$", stripped)
+        match = RE_NAME_WEIGHT.match(stripped)
         if match and indent == base_indent:
             current_instrument = match.group(1)
             current_instrument_weight = float(match.group(2))
@@ -120,13 +152,11 @@ def parse_nested_signal(lines, start_idx, component_index):
             continue
 
         # Component line: "direct: 0.9" or "early: 0.1"
-        match = re.match(r"(direct|early):\s*([0-9.]+)\s*$", stripped)
+        match = RE_COMPONENT_WEIGHT.match(stripped)
         if match and current_instrument and indent > base_indent:
             comp_type = match.group(1)
             comp_weight = float(match.group(2))
-            comp_name = f"{current_instrument}_{comp_type}"
-            if comp_name in component_index:
-                weights[component_index[comp_name]] = current_instrument_weight * comp_weight
+            weights[f"{current_instrument}_{comp_type}"] = current_instrument_weight * comp_weight
             i += 1
             continue
 
@@ -135,30 +165,63 @@ def parse_nested_signal(lines, start_idx, component_index):
     return weights, i
 
 
-def parse_spec_file(filepath):
-    with open(filepath, "r") as f:
-        lines = f.readlines()
-
+def parse_spec_statements(prepared_lines):
+    """Parse target, hall gain and signal statements from (indent, stripped) tuples."""
     instruments = []
     target_weights = {}
     hall_gain_db = 0.0
+    signals = []
     i = 0
-    while i < len(lines):
-        line = lines[i]
-        stripped = line.strip()
+    while i < len(prepared_lines):
+        indent, stripped = prepared_lines[i]
+
+        if not stripped or stripped.startswith("#"):
+            i += 1
+            continue
 
         if stripped == "target:":
-            instruments, target_weights, i = parse_nested_target(lines, i + 1)
+            instruments, target_weights, i = parse_nested_target(prepared_lines, i + 1, indent)
             continue
 
-        match = re.match(r"hall\s+gain:\s*(-?[0-9.]+)\s*$", stripped)
+        match = RE_HALL_GAIN.match(stripped)
         if match:
             hall_gain_db = float(match.group(1))
             i += 1
             continue
 
+        # Nested signal format: "signal voc:" on its own line
+        match = RE_SIGNAL_NESTED.match(stripped)
+        if match:
+            name = match.group(1)
+            weights, i = parse_nested_signal(prepared_lines, i + 1, indent)
+            signals.append({"name": name, "weights": weights, "is_hall": False})
+            continue
+
+        # Inline signal format: "signal voc: 0.5 voc_direct, ..."
+        match = RE_SIGNAL_INLINE.match(stripped)
+        if match:
+            name = match.group(1)
+            weights = parse_signal_components(match.group(2), name)
+            signals.append({"name": name, "weights": weights, "is_hall": False})
+            i += 1
+            continue
+
         i += 1
 
+    return instruments, target_weights, hall_gain_db, signals
+
+
+def parse_spec_file(filepath):
+    # Each line as (indent, stripped text), so parsers never re-strip
+    with open(filepath, "r") as f:
+        prepared_lines = [(len(line) - len(line.lstrip()), line.strip()) for line in f]
+
+    try:
+        instruments, target_weights, hall_gain_db, signals = parse_spec_statements(prepared_lines)
+    except ValueError as err:
+        # Weights like "0.5." match [0-9.]+ but are not valid floats
+        return None, f"Invalid number in spec file: {err}"
+
     if not instruments:
         return None, "No target section found in spec file"
 
@@ -176,34 +239,14 @@ def parse_spec_file(filepath):
         target[component_index[f"{instr}_direct"]] = instr_weight * direct_ratio
         target[component_index[f"{instr}_early"]] = instr_weight * early_ratio
 
-    signals = []
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        stripped = line.strip()
-
-        if not stripped or stripped.startswith("#"):
-            i += 1
-            continue
-
-        # Nested signal format: "signal voc:" on its own line
-        match = re.match(r"signal\s+(\S+):\s*$", stripped)
-        if match:
-            name = match.group(1)
-            weights, i = parse_nested_signal(lines, i + 1, component_index)
-            signals.append({"name": name, "weights": weights, "is_hall": False})
-            continue
-
-        # Inline signal format: "signal voc: 0.5 voc_direct, ..."
-        match = re.match(r"signal\s+(\S+):\s*(.+)$", stripped)
-        if match:
-            name = match.group(1)
-            weights = parse_signal_components(match.group(2), name, component_index)
-            signals.append({"name": name, "weights": weights, "is_hall": False})
-            i += 1
-            continue
-
-        i += 1
+    # Signals may precede the target block, so resolve component names to
+    # indices only once every component is known
+    for signal in signals:
+        signal["weights"] = {
+            component_index[name]: weight
+            for name, weight in signal["weights"].items()
+            if name in component_index
+        }
 
     return {
         "components": components,
@@ -216,42 +259,42 @@ def parse_spec_file(filepath):
 
 
 def add_hall_signals(spec, track_names):
-    instruments = set(spec["instruments"])
+    hall_tracks = {f"{instr}_hall": instr for instr in spec["instruments"]}
     hall_gain_linear = db_to_linear(spec.get("hall_gain_db", 0))
 
     for track_name in track_names:
-        track_name_normalized = track_name.lower().replace(" ", "_")
+        instr = hall_tracks.get(track_name.lower().replace(" ", "_"))
+        if instr is None:
+            continue
 
-        for instr in instruments:
-            if track_name_normalized == f"{instr}_hall":
-                early_component = f"{instr}_early"
-                if early_component in spec["component_index"]:
-                    weights = {spec["component_index"][early_component]: hall_gain_linear}
-                    spec["signals"].append({
-                        "name": track_name,
-                        "weights": weights,
-                        "is_hall": True
-                    })
-                break
+        early_component = f"{instr}_early"
+        if early_component in spec["component_index"]:
+            weights = {spec["component_index"][early_component]: hall_gain_linear}
+            spec["signals"].append({
+                "name": track_name,
+                "weights": weights,
+                "is_hall": True
+            })
 
 
 def build_matrices(spec):
     num_components = len(spec["components"])
     num_signals = len(spec["signals"])
 
-    A = np.zeros((num_components, num_signals))
-    is_hall = np.zeros(num_signals)
-    signal_names = []
+    signal_names = [signal["name"] for signal in spec["signals"]]
+    is_hall = np.array([1.0 if signal["is_hall"] else 0.0 for signal in spec["signals"]])
 
+    rows, cols, vals = [], [], []
     for j, signal in enumerate(spec["signals"]):
-        signal_names.append(signal["name"])
-        is_hall[j] = 1 if signal["is_hall"] else 0
-        for idx, weight in signal["weights"].items():
-            A[idx, j] = weight
+        rows.extend(signal["weights"].keys())
+        cols.extend([j] * len(signal["weights"]))
+        vals.extend(signal["weights"].values())
+
+    A = np.zeros((num_components, num_signals))
+    A[np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)] = vals
 
     target = np.zeros(num_components)
-    for idx, weight in spec["target"].items():
-        target[idx] = weight
+    target[np.fromiter(spec["target"].keys(), dtype=int)] = list(spec["target"].values())
 
     return A, target, is_hall, signal_names
 
@@ -272,52 +315,45 @@ def solve_mix(A, target, is_hall):
     # Small value means prioritize matching target over minimizing hall
     HALL_PENALTY = 0.01
 
-    def objective(x):
-        residual = A @ x - target
-        target_error = np.sum(residual ** 2)
-        hall_penalty = HALL_PENALTY * np.sum((x * is_hall) ** 2)
-        return target_error + hall_penalty
-
-    def objective_grad(x):
-        residual = A @ x - target
-        target_grad = 2 * A.T @ residual
-        hall_grad = 2 * HALL_PENALTY * x * is_hall
-        return target_grad + hall_grad
-
-    bounds = [(0, None) for _ in range(num_signals)]
-    x0 = np.ones(num_signals) * 0.3
-
-    result = minimize(
-        objective,
-        x0,
-        method="L-BFGS-B",
-        jac=objective_grad,
-        bounds=bounds,
-        options={"ftol": 1e-12, "maxiter": 1000}
-    )
-
-    residual = A @ result.x - target
+    # Round-off below zero that still counts as a non-negative level
+    NEGATIVE_TOLERANCE = 1e-12
+
+    # Fold the hall penalty into the least-squares system as extra rows:
+    # ||[A; sqrt(p) * diag(is_hall)] @ x - [target; 0]||^2 is the objective above.
+    A_aug = np.vstack([A, np.sqrt(HALL_PENALTY) * np.diag(is_hall)])
+    b_aug = np.concatenate([target, np.zeros(num_signals)])
+
+    # The unconstrained least-squares optimum is also the constrained one
+    # whenever it is already non-negative, which is the common case
+    x, *_ = lstsq(A_aug, b_aug, lapack_driver="gelsd")
+    if (x >= -NEGATIVE_TOLERANCE).all():
+        x = np.maximum(x, 0)
+        success = True
+    else:
+        try:
+            x, _ = nnls(A_aug, b_aug, maxiter=10 * num_signals)
+            success = True
+        except RuntimeError:
+            # NNLS hit its iteration limit; retry with bounded-variable least squares
+            result = lsq_linear(A_aug, b_aug, bounds=(0.0, np.inf), method="bvls", tol=1e-10)
+            x = result.x
+            success = result.success
+
+    residual = A @ x - target
     error = np.linalg.norm(residual)
 
-    return result.x, error, result.success
+    return x, error, success
 
 
-def main():
-    if len(sys.argv) != 4:
-        print("Usage: python3 automix_solve.py <spec_file> <track_list_file> <output_file>", file=sys.stderr)
-        sys.exit(1)
-
-    spec_file = sys.argv[1]
-    track_list_file = sys.argv[2]
-    output_file = sys.argv[3]
-
+def solve_one(spec_file, track_list_file, output_file):
+    """Solve one spec and write its JSON result. Returns False if the spec is invalid."""
     # Parse spec
     spec, err = parse_spec_file(spec_file)
     if not spec:
         result = {"success": False, "error": err}
         with open(output_file, "w") as f:
             json.dump(result, f)
-        sys.exit(1)
+        return False
 
     # Read track list
     with open(track_list_file, "r") as f:
@@ -329,42 +365,43 @@ def main():
     # Build matrices and solve
     A, target, is_hall, signal_names = build_matrices(spec)
 
-    # Log analysis info
+    # Log analysis info (only built on request; automix.lua just needs levels)
     analysis_lines = []
-    analysis_lines.append("Signal matrix (what each signal contributes to each component):")
-    for j, sig_name in enumerate(signal_names):
-        contributions = []
+    if os.environ.get("AUTOMIX_VERBOSE") == "1":
+        analysis_lines.append("Signal matrix (what each signal contributes to each component):")
+        sig_idx, comp_idx = np.nonzero(A.T > 0.001)
+        percents = A.T[sig_idx, comp_idx] * 100
+        splits = np.searchsorted(sig_idx, np.arange(1, len(signal_names)))
+        groups = zip(np.split(comp_idx, splits), np.split(percents, splits))
+        for sig_name, hall, (comps, pcts) in zip(signal_names, is_hall, groups):
+            contributions = ", ".join(f"{spec['components'][i]}: {pct:.1f}%" for i, pct in zip(comps, pcts))
+            hall_marker = " [hall]" if hall else ""
+            analysis_lines.append(f"  {sig_name}{hall_marker}: {contributions}")
+
+        analysis_lines.append("")
+        analysis_lines.append("Target mix:")
         for i, comp_name in enumerate(spec["components"]):
-            if A[i, j] > 0.001:
-                contributions.append(f"{comp_name}: {A[i,j]*100:.1f}%")
-        hall_marker = " [hall]" if is_hall[j] else ""
-        analysis_lines.append(f"  {sig_name}{hall_marker}: {', '.join(contributions)}")
-
-    analysis_lines.append("")
-    analysis_lines.append("Target mix:")
-    for i, comp_name in enumerate(spec["components"]):
-        analysis_lines.append(f"  {comp_name}: {target[i]*100:.1f}%")
+            analysis_lines.append(f"  {comp_name}: {target[i]*100:.1f}%")
 
     solution, error, success = solve_mix(A, target, is_hall)
 
     # Build result
-    levels = {}
-    for j, name in enumerate(signal_names):
-        levels[name] = {
-            "linear": float(solution[j]),
-            "db": float(linear_to_db(solution[j])),
-            "is_hall": bool(is_hall[j])
-        }
+    with np.errstate(divide="ignore"):
+        solution_db = np.where(solution > 0, 20.0 * np.log10(solution), -150.0)
+    levels = {
+        name: {"linear": lin, "db": db, "is_hall": hall}
+        for name, lin, db, hall in zip(
+            signal_names, solution.tolist(), solution_db.tolist(), (is_hall > 0).tolist())
+    }
 
     # Compute achieved mix
     achieved = A @ solution
-    achieved_mix = {}
-    for i, name in enumerate(spec["components"]):
-        achieved_mix[name] = {
-            "achieved": float(achieved[i]),
-            "target": float(target[i]),
-            "diff": float(achieved[i] - target[i])
-        }
+    diff = achieved - target
+    achieved_mix = {
+        name: {"achieved": ach, "target": tgt, "diff": d}
+        for name, ach, tgt, d in zip(
+            spec["components"], achieved.tolist(), target.tolist(), diff.tolist())
+    }
 
     # Generate helpful error message if target not achievable
     error_message = None
@@ -393,7 +430,39 @@ def main():
     }
 
     with open(output_file, "w") as f:
-        json.dump(result, f, indent=2)
+        if orjson:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
+        else:
+            json.dump(result, f, indent=2)
+
+    return True
+
+
+def main():
+    if len(sys.argv) == 2 and sys.argv[1] == "--batch":
+        # One "<spec_file>\t<track_list_file>\t<output_file>" job per stdin line
+        ok = True
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) != 3:
+                print(f"Skipping malformed batch line: {line.rstrip()}", file=sys.stderr)
+                ok = False
+                continue
+            try:
+                ok = solve_one(*fields) and ok
+            except (OSError, ValueError) as err:
+                print(f"Skipping job {line.rstrip()}: {err}", file=sys.stderr)
+                ok = False
+        sys.exit(0 if ok else 1)
+
+    if len(sys.argv) != 4:
+        print(USAGE, file=sys.stderr)
+        sys.exit(1)
+
+    if not solve_one(sys.argv[1], sys.argv[2], sys.argv[3]):
+        sys.exit(1)
 
 
 if __name__ == "__main__":